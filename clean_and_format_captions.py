@@ -1,20 +1,24 @@
 import os
-import json
+import orjson
 import re
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 # Default configuration
 DEFAULT_CAPTIONS_DIR = 'Human_Captions'
 DEFAULT_INPUT_DIR = 'input'
 VIDEO_EXT = '.mp4'
 JSON_SUFFIX = '_analysis.json'
+METADATA_KEYS = ['usage_metadata', 'file_metadata']
+
+_TRAILING_COMMA_RE = re.compile(r',(\s*[}\]])')
 
 def fix_json_content(content):
     """
     Attempts to fix common JSON syntax errors.
     """
     # Fix 1: Remove trailing commas before closing braces/brackets
-    content = re.sub(r',(\s*[}\]])', r'\1', content)
+    content = _TRAILING_COMMA_RE.sub(r'\1', content)
     return content
 
 def clean_orphans(captions_dir, input_dir):
@@ -27,22 +31,74 @@ def clean_orphans(captions_dir, input_dir):
         print(f"Error: Directories {captions_dir} or {input_dir} not found.")
         return
 
-    for filename in os.listdir(captions_dir):
-        if filename.endswith(JSON_SUFFIX):
-            base_name = filename.replace(JSON_SUFFIX, '')
-            video_path = os.path.join(input_dir, base_name + VIDEO_EXT)
-            
-            if not os.path.exists(video_path):
-                file_to_delete = os.path.join(captions_dir, filename)
-                try:
-                    os.remove(file_to_delete)
-                    print(f"Deleted orphan: {filename}")
-                    deleted_count += 1
-                except OSError as e:
-                    print(f"Error deleting {filename}: {e}")
+    # Read the video directory once instead of probing for each caption
+    with os.scandir(input_dir) as it:
+        video_set = {entry.name[:-len(VIDEO_EXT)] for entry in it if entry.name.endswith(VIDEO_EXT)}
+
+    with os.scandir(captions_dir) as it:
+        entries = [entry for entry in it if entry.name.endswith(JSON_SUFFIX)]
+
+    for entry in entries:
+        filename = entry.name
+        base_name = filename[:-len(JSON_SUFFIX)]
+
+        if base_name not in video_set:
+            try:
+                os.remove(entry.path)
+                print(f"Deleted orphan: {filename}")
+                deleted_count += 1
+            except OSError as e:
+                print(f"Error deleting {filename}: {e}")
     
     print(f"Deleted {deleted_count} orphaned files.\n")
 
+def _process_one(entry):
+    """
+    Fixes and cleans a single caption file. Returns (processed, fixed, error) counts.
+    """
+    filename = entry.name
+    file_path = entry.path
+    fixed = 0
+
+    try:
+        with open(file_path, 'rb') as f:
+            content = f.read()
+        
+        # 1. Try to load JSON
+        try:
+            data = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            # 2. If load fails, try to fix syntax
+            fixed_content = fix_json_content(content.decode('utf-8'))
+            try:
+                data = orjson.loads(fixed_content)
+                fixed = 1
+            except orjson.JSONDecodeError as e:
+                print(f"Failed to fix JSON syntax in {filename}: {e}")
+                return 0, 0, 1
+
+        # 3. Remove metadata
+        modified = False
+        for key in METADATA_KEYS:
+            if key in data:
+                del data[key]
+                modified = True
+        
+        # Serialize up front so the file is written with a single write() call
+        output = orjson.dumps(data, option=orjson.OPT_INDENT_2)
+
+        # Only write back when the content or its indentation/formatting changed
+        needs_write = fixed or modified or output != content
+        if needs_write:
+            with open(file_path, 'wb') as f:
+                f.write(output)
+        
+        return 1, fixed, 0
+
+    except Exception as e:
+        print(f"Unexpected error processing {filename}: {e}")
+        return 0, fixed, 1
+
 def process_files(captions_dir):
     """
     Iterates through files, fixes formatting, and removes metadata.
@@ -51,53 +107,20 @@ def process_files(captions_dir):
     processed_count = 0
     fixed_count = 0
     error_count = 0
-    
-    keys_to_remove = ['usage_metadata', 'file_metadata']
 
     if not os.path.exists(captions_dir):
         print(f"Error: Directory {captions_dir} not found.")
         return
 
-    for filename in os.listdir(captions_dir):
-        if not filename.endswith(JSON_SUFFIX):
-            continue
-            
-        file_path = os.path.join(captions_dir, filename)
-        
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            
-            # 1. Try to load JSON
-            try:
-                data = json.loads(content)
-            except json.JSONDecodeError:
-                # 2. If load fails, try to fix syntax
-                fixed_content = fix_json_content(content)
-                try:
-                    data = json.loads(fixed_content)
-                    fixed_count += 1
-                except json.JSONDecodeError as e:
-                    print(f"Failed to fix JSON syntax in {filename}: {e}")
-                    error_count += 1
-                    continue
-
-            # 3. Remove metadata
-            modified = False
-            for key in keys_to_remove:
-                if key in data:
-                    del data[key]
-                    modified = True
-            
-            # Always write back to ensure consistent indentation/formatting
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
-            
-            processed_count += 1
-
-        except Exception as e:
-            print(f"Unexpected error processing {filename}: {e}")
-            error_count += 1
+    with os.scandir(captions_dir) as it:
+        entries = [entry for entry in it if entry.name.endswith(JSON_SUFFIX)]
+
+    # Files are small and independent, so overlap their read/write latency
+    with ThreadPoolExecutor(max_workers=(os.cpu_count() or 1) * 4) as executor:
+        for processed, fixed, error in executor.map(_process_one, entries):
+            processed_count += processed
+            fixed_count += fixed
+            error_count += error
 
     print(f"Processed {processed_count} files.")
     print(f"Repaired syntax in {fixed_count} files.")
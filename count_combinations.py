@@ -1,58 +1,68 @@
 import os
-import json
+import orjson
 import argparse
-from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+def _read_combination(filepath):
+    """Returns the combination index ((winter << 1) | present) for a file and an error flag."""
+    filename = os.path.basename(filepath)
+    try:
+        with open(filepath, 'rb') as f:
+            data = orjson.loads(f.read())
+            
+        # Missing keys are the rare case, so look them up directly.
+        # A TypeError (e.g. "weather" is not an object) is malformed data and
+        # falls through to the error handler below.
+        try:
+            winter_weather = data['weather']['winter weather']
+        except KeyError:
+            # print(f"Warning: 'winter weather' missing in {filename}")
+            winter_weather = None
+        try:
+            hazardous_present = data['hazardous event']['present']
+        except KeyError:
+            # print(f"Warning: 'hazardous event.present' missing in {filename}")
+            hazardous_present = None
+            
+        # Values other than booleans or missing can't be tabulated, so report them
+        for value in (winter_weather, hazardous_present):
+            if value is not None and not isinstance(value, bool):
+                print(f"Error processing {filename}: unexpected value {value!r}")
+                return None, 1
+            
+        # Only count if both are present
+        if winter_weather is not None and hazardous_present is not None:
+            return (int(winter_weather) << 1) | int(hazardous_present), 0
+        return None, 0
+        
+    except orjson.JSONDecodeError:
+        print(f"Error decoding JSON: {filename}")
+        return None, 1
+    except Exception as e:
+        print(f"Error processing {filename}: {e}")
+        return None, 1
 
 def count_combinations(directory):
     if not os.path.exists(directory):
         print(f"Error: Directory '{directory}' not found.")
         return
 
-    counts = defaultdict(int)
-    
-    # Initialize all keys to 0
-    keys = [
-        (True, True),
-        (True, False),
-        (False, True),
-        (False, False)
-    ]
-    for k in keys:
-        counts[k] = 0
+    # Counts indexed by (winter << 1) | present
+    counts = [0, 0, 0, 0]
 
-    files = [f for f in os.listdir(directory) if f.endswith('_analysis.json')]
+    with os.scandir(directory) as it:
+        files = [entry.path for entry in it if entry.name.endswith('_analysis.json')]
     
     print(f"Scanning {len(files)} files in {directory}...")
     
     error_count = 0
-    
-    for filename in files:
-        filepath = os.path.join(directory, filename)
-        try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                
-            winter_weather = data.get('weather', {}).get('winter weather')
-            hazardous_present = data.get('hazardous event', {}).get('present')
-            
-            # Ensure they are booleans or handle missing data appropriately
-            if winter_weather is None:
-                # print(f"Warning: 'winter weather' missing in {filename}")
-                pass
-            if hazardous_present is None:
-                # print(f"Warning: 'hazardous event.present' missing in {filename}")
-                pass
-                
-            # Only count if both are present (or treat None as distinct if needed, but here we skip or count as None)
-            if winter_weather is not None and hazardous_present is not None:
-                counts[(winter_weather, hazardous_present)] += 1
-            
-        except json.JSONDecodeError:
-            print(f"Error decoding JSON: {filename}")
-            error_count += 1
-        except Exception as e:
-            print(f"Error processing {filename}: {e}")
-            error_count += 1
+
+    # Parsing is CPU-bound, so spread it across processes; chunks amortize IPC
+    with ProcessPoolExecutor() as executor:
+        for index, error in executor.map(_read_combination, files, chunksize=64):
+            if index is not None:
+                counts[index] += 1
+            error_count += error
             
     # Prepare table data
     print("\nResults:")
@@ -60,15 +70,14 @@ def count_combinations(directory):
     print(f"| {'Winter Weather':<15} | {'Hazardous Event':<15} | {'Count':<10} |")
     print("-" * 55)
     
-    # Sort for consistent output
-    sorted_keys = sorted(counts.keys(), key=lambda x: (not x[0], not x[1])) # True first
-    
-    for winter, present in sorted_keys:
-        print(f"| {str(winter):<15} | {str(present):<15} | {counts[(winter, present)]:<10} |")
+    # True first
+    for winter, present in [(True, True), (True, False), (False, True), (False, False)]:
+        count = counts[(int(winter) << 1) | int(present)]
+        print(f"| {str(winter):<15} | {str(present):<15} | {count:<10} |")
         
     print("-" * 55)
     
-    total = sum(counts.values())
+    total = sum(counts)
     print(f"\nTotal files counted: {total}")
     if error_count > 0:
         print(f"Files with errors: {error_count}")
@@ -1,31 +1,41 @@
 import os
 import json
+import orjson
 import random
+import re
+import shutil
+import subprocess
 import time
 from datetime import datetime
-from collections import deque
+from fractions import Fraction
 from threading import Lock
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 import logging
-import cv2
+from logging.handlers import MemoryHandler
 import dashscope
 from dashscope import MultiModalConversation
 
 # Set up verbose logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+_JSON_BODY_RE = re.compile(r'\{.*\}', re.S)
+
+VIDEO_EXTENSIONS = {'mp4', 'mov', 'avi'}
+FFPROBE_TIMEOUT_SECONDS = 30
+
 def load_config():
     """Loads settings, prompts, and schema from config files."""
     try:
-        with open('configs/settings.json', 'r') as f:
-            settings = json.load(f)
-        with open('configs/prompts.json', 'r') as f:
-            prompts = json.load(f)
-        with open('configs/schemas/video_response.schema.json', 'r') as f:
-            schema = json.load(f)
+        with open('configs/settings.json', 'rb') as f:
+            settings = orjson.loads(f.read())
+        with open('configs/prompts.json', 'rb') as f:
+            prompts = orjson.loads(f.read())
+        with open('configs/schemas/video_response.schema.json', 'rb') as f:
+            schema = orjson.loads(f.read())
         return settings, prompts, schema
     except FileNotFoundError as e:
         logging.error(f"Configuration file not found: {e.filename}")
@@ -35,24 +45,45 @@ def load_config():
         exit(1)
 
 def get_video_files(input_dir, output_dir, max_items, shuffle):
-    """Gets a list of video files to process."""
+    """Gets a list of (filename, size in bytes) tuples for the videos to process."""
     if not os.path.exists(input_dir):
         logging.warning(f"Input directory not found: {input_dir}")
         return []
 
-    all_videos = [f for f in os.listdir(input_dir) if f.lower().endswith(('.mp4', '.mov', '.avi'))]
+    # Suffixes are known, so split names with rpartition/slicing instead of splitext
+    all_map = {}
+    with os.scandir(input_dir) as it:
+        for e in it:
+            name, _, ext = e.name.rpartition('.')
+            if name and ext.lower() in VIDEO_EXTENSIONS:
+                all_map[name] = e
     
     if not os.path.exists(output_dir):
         os.makedirs(output_dir, exist_ok=True)
         
-    processed_videos = {os.path.splitext(f)[0] for f in os.listdir(output_dir) if f.endswith('.json')}
+    with os.scandir(output_dir) as it:
+        processed_videos = {e.name[:-5] for e in it if e.name.endswith('.json')}
     
-    videos_to_process = [v for v in all_videos if os.path.splitext(v)[0] not in processed_videos]
+    # Set difference order is arbitrary, so sort when not shuffling to keep runs repeatable
+    candidates = list(all_map.keys() - processed_videos)
 
     if shuffle:
-        random.shuffle(videos_to_process)
+        random.shuffle(candidates)
+    else:
+        candidates.sort()
+
+    # Stat only the selected videos; process_video reuses the size instead of stat-ing again
+    videos_to_process = []
+    for k in candidates:
+        if len(videos_to_process) >= max_items:
+            break
+        entry = all_map[k]
+        try:
+            videos_to_process.append((entry.name, entry.stat().st_size))
+        except OSError as e:
+            logging.warning(f"Skipping unreadable video {entry.name}: {e}")
 
-    return videos_to_process[:max_items]
+    return videos_to_process
 
 def calculate_cost(input_tokens, output_tokens, model):
     """Calculate cost based on token usage and model pricing."""
@@ -109,7 +140,39 @@ def calculate_cost(input_tokens, output_tokens, model):
         "pricing_model": model_key
     }
 
-def process_video(video_path, prompts, schema, model, settings):
+def probe_video(video_path):
+    """Reads resolution and length of a local video file from its container header."""
+    cmd = [
+        "ffprobe", "-v", "error", "-select_streams", "v:0",
+        "-show_entries", "stream=width,height,r_frame_rate,nb_frames,duration:format=duration",
+        "-of", "json", video_path
+    ]
+    try:
+        proc = subprocess.run(cmd, capture_output=True, check=True, timeout=FFPROBE_TIMEOUT_SECONDS)
+        info = orjson.loads(proc.stdout)
+        stream = info["streams"][0]
+    except (OSError, subprocess.SubprocessError, ValueError, KeyError, IndexError) as e:
+        logging.warning(f"Could not probe video {os.path.basename(video_path)}: {e}")
+        return "0x0", 0
+
+    resolution = f"{stream.get('width', 0)}x{stream.get('height', 0)}"
+
+    # Prefer the stream duration, then the container duration, then frames / fps.
+    # ffprobe reports unknown values as "N/A", so skip those when falling back.
+    durations = [stream.get("duration"), info.get("format", {}).get("duration")]
+    duration = next((d for d in durations if d not in (None, "N/A")), None)
+    if duration is not None:
+        video_length_seconds = float(duration)
+    else:
+        try:
+            video_fps = float(Fraction(stream.get("r_frame_rate", "0/1")))
+            total_frames = int(stream.get("nb_frames", 0))
+        except (ValueError, ZeroDivisionError):
+            video_fps, total_frames = 0, 0
+        video_length_seconds = total_frames / video_fps if video_fps > 0 else 0
+    return resolution, video_length_seconds
+
+def process_video(video_path, file_size_bytes, video_info, prompt_text, model, settings):
     """Processes a single video by uploading it and returning the caption with metadata."""
     try:
         logging.info(f"Processing video: {os.path.basename(video_path)}")
@@ -118,15 +181,8 @@ def process_video(video_path, prompts, schema, model, settings):
         vid_settings = settings.get('vid_caption', {})
         fps = vid_settings.get('frame_sampling_fps', 1.0) # Default to 1.0 if not set
 
-        # Get video info locally first
-        cap = cv2.VideoCapture(video_path)
-        video_fps = cap.get(cv2.CAP_PROP_FPS)
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        video_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        video_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        resolution = f"{video_width}x{video_height}"
-        video_length_seconds = total_frames / video_fps if video_fps > 0 else 0
-        cap.release()
+        # Video info is probed locally ahead of time by probe_video
+        resolution, video_length_seconds = video_info
 
         # 1. Upload the video file directly to DashScope
         # For international users, we should check if we need to set the oss endpoint differently,
@@ -142,18 +198,13 @@ def process_video(video_path, prompts, schema, model, settings):
         abs_video_path = os.path.abspath(video_path)
         file_uri = f"file://{abs_video_path}"
         
-        # Prepare content
-        # Inject schema into system prompt to ensure JSON compliance
-        schema_str = json.dumps(schema, indent=2)
-        system_instruction = f"{prompts['video']['system']}\n\nIMPORTANT: You must strictly follow this JSON schema:\n{schema_str}"
-        
         # Qwen-VL MultiModalConversation format
         messages = [
             {
                 "role": "user",
                 "content": [
                     {"video": file_uri, "fps": fps},
-                    {"text": f"{system_instruction}\n\n{prompts['video']['user']}"}
+                    {"text": prompt_text}
                 ]
             }
         ]
@@ -200,7 +251,6 @@ def process_video(video_path, prompts, schema, model, settings):
         logging.info(f"  - Output tokens: {output_tokens:,}")
         logging.info(f"  - Estimated cost: ${cost_info['total_cost_usd']:.6f}")
         
-        file_size_bytes = os.path.getsize(video_path)
         file_size_mb = round(file_size_bytes / (1024 * 1024), 2)
         video_length_formatted = f"{int(video_length_seconds // 60)}:{(int(video_length_seconds % 60)):02d}" if video_length_seconds > 0 else "0:00"
         analysis_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -237,6 +287,13 @@ def process_video(video_path, prompts, schema, model, settings):
 
 def main():
     """Main function to run the video captioning process."""
+    # Buffer log records so workers don't contend on stderr for every message;
+    # warnings and errors still flush immediately, and logging.shutdown flushes the rest at exit
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    memory_handler = MemoryHandler(capacity=256, flushLevel=logging.WARNING, target=stream_handler)
+    logger.handlers = [memory_handler]
+    
     load_dotenv()
     
     api_key = os.getenv("DASHSCOPE_API_KEY")
@@ -244,6 +301,12 @@ def main():
         logging.error("DASHSCOPE_API_KEY not found in .env file.")
         exit(1)
     
+    # Video metadata comes from ffprobe; without it every video would be
+    # captioned with empty metadata and then skipped as already processed
+    if shutil.which("ffprobe") is None:
+        logging.error("ffprobe not found on PATH. Install FFmpeg to read video metadata.")
+        exit(1)
+    
     dashscope.api_key = api_key
     
     # IMPORTANT: Set base_url for international users globally for DashScope SDK.
@@ -259,6 +322,12 @@ def main():
     
     settings, prompts, schema = load_config()
     
+    # Inject schema into system prompt to ensure JSON compliance.
+    # The prompt is static for the whole run, so build it once here.
+    schema_str = json.dumps(schema, indent=2)
+    system_instruction = f"{prompts['video']['system']}\n\nIMPORTANT: You must strictly follow this JSON schema:\n{schema_str}"
+    prompt_text = f"{system_instruction}\n\n{prompts['video']['user']}"
+    
     vid_caption_settings = settings.get('vid_caption', {})
     common_settings = settings.get('common', {})
     safety_settings = settings.get('safety', {})
@@ -290,38 +359,50 @@ def main():
 
     logging.info(f"Found {len(video_files)} new videos to process.")
     
-    request_timestamps = deque()
-    token_timestamps = deque()
+    # Token bucket for RPM: refills continuously at max_rpm per minute,
+    # or slower if request_delay asks for wider spacing between requests.
+    # Capacity is a single token so bursts can't push a 60s window past max_rpm.
+    refill_rate = max_rpm / 60
+    if request_delay > 0:
+        refill_rate = min(refill_rate, 1 / request_delay)
+    bucket_capacity = 1
+    bucket_tokens = float(bucket_capacity)
+    logging.info(f"Dispatching at most one request every {1 / refill_rate:.2f} seconds.")
+    last_refill = time.monotonic()
     rpm_lock = Lock()
-    tpm_lock = Lock()
     
     def wait_for_rate_limits(estimated_tokens=0):
-        # ... (same implementation as before)
-        wait_time_rpm = 0
+        nonlocal bucket_tokens, last_refill
         with rpm_lock:
-            current_time = time.time()
-            while request_timestamps and current_time - request_timestamps[0] > 60:
-                request_timestamps.popleft()
-            if len(request_timestamps) >= max_rpm:
-                wait_time_rpm = max(0, request_timestamps[0] + 60 - current_time)
+            now = time.monotonic()
+            bucket_tokens = min(bucket_capacity, bucket_tokens + (now - last_refill) * refill_rate)
+            last_refill = now
+            # Reserve a token up front; a negative balance is the wait until it refills
+            bucket_tokens -= 1
+            wait_time = -bucket_tokens / refill_rate if bucket_tokens < 0 else 0
         
-        wait_time = max(wait_time_rpm, 0)
         if wait_time > 0:
-            logging.warning(f"Rate limit reached. Waiting {wait_time:.2f} seconds...")
+            # Waiting for the next token is the normal request spacing, not an error
+            logging.debug(f"Rate limit spacing. Waiting {wait_time:.2f} seconds...")
             time.sleep(wait_time)
-        
-        with rpm_lock:
-            request_timestamps.append(time.time())
 
-    def submit_with_rate_limit_check(video_path):
+    def submit_with_rate_limit_check(video_path, file_size_bytes, video_info):
         # Estimate tokens loosely for video (e.g. 5000 tokens per video as a placeholder)
         estimated_tokens = 5000 
         wait_for_rate_limits(estimated_tokens)
         
-        return process_video(video_path, prompts, schema, model, settings)
+        return process_video(video_path, file_size_bytes, video_info, prompt_text, model, settings)
+
+    # Probe video metadata up front so API workers never wait on local disk reads
+    video_paths = [os.path.join(input_dir, vf) for vf, _ in video_files]
+    with ThreadPoolExecutor(max_workers=min(8, len(video_paths))) as prefetch:
+        video_infos = list(prefetch.map(probe_video, video_paths))
 
     with ThreadPoolExecutor(max_workers=concurrency) as executor:
-        futures = {executor.submit(submit_with_rate_limit_check, os.path.join(input_dir, vf)): vf for vf in video_files}
+        futures = {}
+        for (vf, size), video_path, video_info in zip(video_files, video_paths, video_infos):
+            future = executor.submit(submit_with_rate_limit_check, video_path, size, video_info)
+            futures[future] = vf
 
         for future in as_completed(futures):
             video_file = futures[future]
@@ -331,22 +412,14 @@ def main():
             try:
                 result, metadata = future.result()
                 if result:
-                    # Clean markdown code blocks if present
-                    if result.startswith("```json"):
-                        result = result[7:-3]
-                    elif result.startswith("```"):
-                        result = result[3:-3]
-                        
+                    # Extract the outermost JSON object, skipping any markdown code fences
+                    match = _JSON_BODY_RE.search(result)
                     try:
-                        # Attempt to find JSON object
-                        start = result.find('{')
-                        end = result.rfind('}')
-                        if start != -1 and end != -1:
-                            json_res = json.loads(result[start:end+1])
-                            caption_data = json_res
+                        if match:
+                            caption_data = orjson.loads(match.group(0))
                         else:
-                             caption_data = {"caption": result, "error": "JSON parse failed"}
-                    except:
+                            caption_data = {"caption": result, "error": "JSON parse failed"}
+                    except orjson.JSONDecodeError:
                         caption_data = {"caption": result, "error": "JSON parse failed"}
 
                     output_data = {
@@ -355,15 +428,13 @@ def main():
                         "file_metadata": metadata.get("file_metadata", {})
                     }
                     
-                    with open(output_path, 'w') as f:
-                        json.dump(output_data, f, indent=2)
+                    with open(output_path, 'wb') as f:
+                        f.write(orjson.dumps(output_data, option=orjson.OPT_INDENT_2))
                     logging.info(f"Successfully processed {video_file}")
                 else:
                     logging.error(f"Failed to get result for {video_file}")
             except Exception as e:
                 logging.error(f"Error in main loop for {video_file}: {e}")
-            
-            time.sleep(request_delay)
 
 if __name__ == "__main__":
     main()